@@ -12,4 +12,6 @@ from prompt_poet.examples.cai_helpers import *
 from prompt_poet.prompt import *
 from prompt_poet.template import *
 from prompt_poet.template_registry import *
-from pp_exceptions import *
\ No newline at end of file
+from pp_exceptions import *
+# Import as `prompt` does, so e.g. preloading warms the encodings `Prompt` uses.
+from tokenizer import *
\ No newline at end of file
@@ -1,12 +1,18 @@
 """Helpers for CAI-specific example templates."""
 
+import inspect
+import math
 import re
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Union
 
 DEFAULT_USERNAME = "user"
 NARRATOR_NAME = "narrator"
 DASH = "-"
+NAME_CACHE_MAX_SIZE = 4096
+_NARRATOR_RE = re.compile(r"^[\w-]+:")
+_ESCAPE_SEQUENCES_TABLE = str.maketrans({"\n": "\\n", "\r": "\\r"})
 
 
 @dataclass
@@ -23,6 +29,7 @@ class CAIMessage:
     is_pinned: bool = False
 
 
+@lru_cache(maxsize=NAME_CACHE_MAX_SIZE)
 def canonicalize_name(name: Union[str, None]) -> str:
     """Makes name format consistent with author names we use in training data."""
     if not name:
@@ -30,6 +37,7 @@ def canonicalize_name(name: Union[str, None]) -> str:
     return DASH.join(name.split())
 
 
+@lru_cache(maxsize=NAME_CACHE_MAX_SIZE)
 def canonicalize_user_name(name: Union[str, None]) -> str:
     """Makes name format consistent with author names we use in training data."""
     # The "-" is used in upstream components and should be overriden to default value.
@@ -63,14 +71,14 @@ def get_character_definition_messages(
 
 def maybe_inject_narrator(message: str, default_author: str = NARRATOR_NAME) -> str:
     """Inject narrator into the message if applicable."""
-    if re.match(r"^[\w-]+:", message):
+    if _NARRATOR_RE.match(message):
         return message
     return f"{default_author}: {message}"
 
 
 def escape_sequences(message: str) -> str:
     """Escape sequences that will break yaml parsing."""
-    return message.replace("\n", "\\n").replace("\r", "\\r").replace("'", "'")
+    return message.translate(_ESCAPE_SEQUENCES_TABLE)
 
 
 def raise_missing_context_data(key: str):
@@ -86,6 +94,20 @@ def pretruncate_messages(
         return messages
 
     message_truncation_step = token_limit // 10
-    while len(messages) > 2 * message_truncation_step:
-        messages = messages[message_truncation_step:]
-    return messages
+    if not message_truncation_step:
+        return messages
+
+    # Drop whole steps of messages until at most two steps remain.
+    num_surplus_messages = len(messages) - 2 * message_truncation_step
+    if num_surplus_messages <= 0:
+        return messages
+    num_steps = math.ceil(num_surplus_messages / message_truncation_step)
+    return messages[num_steps * message_truncation_step :]
+
+
+# Functions exposed to the Jinja context of the example templates.
+_JINJA_EXPORTS = {
+    name: obj
+    for name, obj in globals().items()
+    if inspect.isfunction(inspect.unwrap(obj)) and obj.__module__ == __name__
+}
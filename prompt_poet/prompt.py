@@ -1,20 +1,28 @@
 """Construct a Prompt Poet (PP) prompt given data and a template."""
 
 import copy
-import inspect
+import json
 import logging
 import math
+from bisect import bisect_left
 from dataclasses import dataclass
-from functools import reduce
+from functools import lru_cache
+from itertools import accumulate, chain, compress, groupby
+from operator import attrgetter
 
 import yaml
 from examples import cai_helpers
 from pp_exceptions import TruncationError
 from template import Template
-from tokenizer import get_encode_func
-from typing import Callable
+from tokenizer import get_encode_batch_func, get_encode_func
+from typing import Callable, Iterator, Literal
 
 SPACE_MARKER = "<|space|>"
+ESCAPE_CACHE_MAX_SIZE = 512
+TEMPLATE_FORMATS = ("yaml", "json")
+_DEFAULT_LOGGER = logging.getLogger(__name__)
+_IMMUTABLE_TYPES = (str, int, float, bool, type(None))
+
 
 @dataclass
 class PromptPart:
@@ -44,6 +52,66 @@ class TruncationBlock:
     total_tokens: int
 
 
+def _fast_clone(obj):
+    """Copy template data, handling builtin containers without `copy.deepcopy`.
+
+    Unlike `copy.deepcopy`, shared references within dicts and lists are not
+    preserved and self-referential containers are not supported.
+    """
+    if isinstance(obj, _IMMUTABLE_TYPES):
+        return obj
+    if type(obj) is dict:
+        return {key: _fast_clone(value) for key, value in obj.items()}
+    if type(obj) is list:
+        return [_fast_clone(value) for value in obj]
+    return copy.deepcopy(obj)
+
+
+@lru_cache(maxsize=32)
+def _build_escape_table(
+    newline: str,
+    escaped_newline: str,
+    carriage_return: str,
+    escaped_carriage_return: str,
+    single_quote: str,
+    escaped_single_quote: str,
+) -> dict[int, str] | None:
+    """Build a `str.translate` table if every escaped sequence is a single character.
+
+    Cached so that prompts sharing the same (e.g. default) configuration share a table.
+    """
+    replacements = {
+        newline: escaped_newline,
+        carriage_return: escaped_carriage_return,
+        single_quote: escaped_single_quote,
+        "\u2028": "\\u2028",  # Unicode line separator
+        "\u2029": "\\u2029",  # Unicode paragraph separator
+        "\u0085": "\\u0085",  # Unicode next line character
+    }
+    if any(len(char) != 1 for char in replacements):
+        return None
+    return str.maketrans(replacements)
+
+
+def _clone_parts(parts: list[PromptPart]) -> list[PromptPart]:
+    """Copy prompt parts; parts only hold primitives and lists of primitives."""
+    return [
+        PromptPart(
+            name=part.name,
+            content=part.content,
+            role=part.role,
+            expected_template_data_keys=(
+                part.expected_template_data_keys.copy()
+                if part.expected_template_data_keys is not None
+                else None
+            ),
+            tokens=part.tokens.copy() if part.tokens is not None else None,
+            truncation_priority=part.truncation_priority,
+        )
+        for part in parts
+    ]
+
+
 class Prompt:
     """Construct a Prompt Poet (PP) prompt given data and a template.
 
@@ -78,6 +146,13 @@ class Prompt:
     :escaped_single_quote: The escaped representation of a single quote in the template.
     :allow_token_overrides: A boolean indicating whether to allow token encoding to be set
         in the template. Not safe for production use.
+    :template_format: The format of the rendered template; either "yaml" (default) or
+        "json". JSON templates render a list of parts, e.g. via the `tojson` filter, and
+        are faster to load. Their content is not unescaped.
+    :encode_batch_func: An optional function used to encode a list of strings into
+        a list of tokens in a single call. Takes precedence over `encode_func` when
+        tokenizing all parts. If neither is provided, the default batch encoding
+        function will be used.
     """
 
     def __init__(
@@ -101,8 +176,15 @@ class Prompt:
         single_quote: str = "'",
         escaped_single_quote: str = "'",
         allow_token_overrides: bool = False,
+        template_format: Literal["yaml", "json"] = "yaml",
+        encode_batch_func: Callable[[list[str]], list[list[int]]] | None = None,
     ):
         """Initialize the prompt object."""
+        if template_format not in TEMPLATE_FORMATS:
+            raise ValueError(
+                f"template_format must be one of {TEMPLATE_FORMATS}: {template_format=}"
+            )
+
         self._template = Template(
             template_path=template_path,
             package_name=package_name,
@@ -111,7 +193,7 @@ class Prompt:
             from_cache=from_cache,
             from_examples=from_examples,
         )
-        self._template_data = copy.deepcopy(template_data)
+        self._template_data = _fast_clone(template_data)
         self._provided_logger = logger
         self._token_limit = token_limit
         self._from_cache = from_cache
@@ -123,15 +205,30 @@ class Prompt:
         self._escaped_carriage_return = escaped_carriage_return
         self._single_quote = single_quote
         self._escaped_single_quote = escaped_single_quote
+        self._escape_table = _build_escape_table(
+            newline=newline,
+            escaped_newline=escaped_newline,
+            carriage_return=carriage_return,
+            escaped_carriage_return=escaped_carriage_return,
+            single_quote=single_quote,
+            escaped_single_quote=escaped_single_quote,
+        )
+        # Per-instance cache; repeated strings in the template are escaped once.
+        self._cached_escape_special_characters = lru_cache(
+            maxsize=ESCAPE_CACHE_MAX_SIZE
+        )(self._escape_special_characters)
         self._encode_func = encode_func
+        self._encode_batch_func = encode_batch_func
         self._tiktoken_encoding_name = tiktoken_encoding_name
         self._truncation_step = truncation_step
         self._allow_token_overrides = allow_token_overrides
+        self._template_format = template_format
 
         self._rendered_template = None
         self._parts = None
         self._parts_bak = None
         self._total_tokens = 0
+        self._untokenized_parts = 0
         self._cached_tokens = None
         self._cached_pretruncation_tokens = None
 
@@ -143,12 +240,29 @@ class Prompt:
         if not self._parts:
             raise ValueError(f"Nothing to tokenize: {self._parts=}.")
 
+        parts_to_tokenize = []
         for part in self._parts:
-            self._tokenize_part(part, force_retokenize=force_retokenize)
-
-        # Create a backup; used for idempotency during truncation.
-        if self._parts_bak is None:
-            self._parts_bak = copy.deepcopy(self._parts)
+            # Avoid retokenizing the part if it has already been tokenized.
+            if part.tokens and force_retokenize:
+                self._total_tokens -= len(part.tokens)
+            elif part.tokens and not force_retokenize:
+                self.logger.warning("Part already tokenized... skipping tokenization.")
+                continue
+            parts_to_tokenize.append(part)
+
+        # Tokenize all remaining, distinct contents in a single batched call.
+        if parts_to_tokenize:
+            self._cached_tokens = None
+            unique_contents = list(
+                dict.fromkeys(part.content for part in parts_to_tokenize)
+            )
+            encoded = dict(zip(unique_contents, self._encode_batch(unique_contents)))
+            for part in parts_to_tokenize:
+                # Copy so that parts with duplicate content never share a token list.
+                part.tokens = encoded[part.content].copy()
+                self._total_tokens += len(part.tokens)
+            # Every part lacking tokens was tokenized above.
+            self._untokenized_parts = 0
 
     def lreplace_at(self, old: str, new: str, index: int):
         """Performs a left replace on the raw string of the part at specified index.
@@ -160,7 +274,7 @@ class Prompt:
         if len(self._parts) > index:
             part = self._parts[index]
             if part.content.startswith(old):
-                self._parts[index].content = f"{new}{part.content.lstrip(old)}"
+                part.content = f"{new}{part.content[len(old):]}"
                 self._tokenize_part(part, force_retokenize=True)
         else:
             raise IndexError(f"Index out of bounds: {index=} {len(self._parts)=}.")
@@ -168,19 +282,25 @@ class Prompt:
     def truncate(self, token_limit: int = None, truncation_step: int = None):
         """An idempotent operation which truncates the rendered template according to the token limit."""
         if token_limit is not None:
-            self.logger.info(f"Overriding {self._token_limit=} with {token_limit=}")
+            self.logger.info(
+                "Overriding self._token_limit=%r with token_limit=%r",
+                self._token_limit,
+                token_limit,
+            )
         else:
             token_limit = self._token_limit
 
         if truncation_step is not None:
             self.logger.info(
-                f"Overriding {self._truncation_step=} with {truncation_step=}"
+                "Overriding self._truncation_step=%r with truncation_step=%r",
+                self._truncation_step,
+                truncation_step,
             )
         else:
             truncation_step = self._truncation_step
 
         if token_limit == -1:
-            self.logger.info(f"No truncation necessary: {token_limit=}")
+            self.logger.info("No truncation necessary: token_limit=%r", token_limit)
             return
 
         # Ensure we have valid values for truncation.
@@ -190,10 +310,14 @@ class Prompt:
             raise ValueError(f"truncation_step must be greater than 0: {truncation_step=}")
 
         # Ensure all parts have been tokenized.
-        if any(part.tokens is None for part in self._parts):
+        if self._untokenized_parts:
             raise ValueError(f"Not all parts have been tokenized. Please tokenize first. {self._parts=}")
 
-        self._reset_parts()
+        # Create a backup on first truncation, else restore from it. Ensures idempotency.
+        if self._parts_bak is None:
+            self._parts_bak = _clone_parts(self._parts)
+        else:
+            self._reset_parts()
 
         num_tokens_to_truncate = self._calculate_num_tokens_to_truncate(
             token_limit=token_limit, truncation_step=truncation_step
@@ -251,22 +375,22 @@ class Prompt:
     @property
     def pretruncation_string(self) -> str:
         """The direct string representation of the prompt prior to truncation."""
-        return reduce(
-            lambda acc, part: acc + part.content, self.pretruncation_parts, ""
-        )
+        return "".join(part.content for part in self.pretruncation_parts)
 
     @property
     def string(self) -> str:
         """The prompt represented as a string."""
-        return reduce(lambda acc, part: acc + part.content, self._parts, "")
+        return "".join(part.content for part in self._parts)
 
     @property
     def pretruncation_tokens(self) -> str:
         """The pre-truncated prompt represented as a list of tokens."""
-        if not self._cached_pretruncation_tokens:
+        if self._cached_pretruncation_tokens is None:
             try:
-                self._cached_pretruncation_tokens = reduce(
-                    lambda acc, part: acc + part.tokens, self.pretruncation_parts, []
+                self._cached_pretruncation_tokens = list(
+                    chain.from_iterable(
+                        part.tokens for part in self.pretruncation_parts
+                    )
                 )
             except TypeError as ex:
                 raise TypeError(
@@ -278,10 +402,10 @@ class Prompt:
     @property
     def tokens(self) -> str:
         """The prompt represented as a list of tokens."""
-        if not self._cached_tokens:
+        if self._cached_tokens is None:
             try:
-                self._cached_tokens = reduce(
-                    lambda acc, part: acc + part.tokens, self._parts, []
+                self._cached_tokens = list(
+                    chain.from_iterable(part.tokens for part in self._parts)
                 )
             except TypeError as ex:
                 raise TypeError(
@@ -301,7 +425,7 @@ class Prompt:
         if self._provided_logger:
             return self._provided_logger
 
-        return logging.getLogger(__name__)
+        return _DEFAULT_LOGGER
 
     def _truncate(
         self, truncation_blocks: list[TruncationBlock], num_tokens_to_truncate: int
@@ -311,27 +435,36 @@ class Prompt:
         if not num_tokens_to_truncate or not truncation_blocks:
             return
 
-        to_remove = [False] * len(self._parts)
+        # A mask of parts to keep; removed spans are zeroed out.
+        to_keep = bytearray(b"\x01") * len(self._parts)
         tokens_removed = 0
         for block in truncation_blocks:
             # Remove the entire block if it fits within the number of tokens to remove.
             if tokens_removed + block.total_tokens <= num_tokens_to_truncate:
-                to_remove[block.left : block.right + 1] = [True] * (
+                to_keep[block.left : block.right + 1] = bytes(
                     block.right - block.left + 1
                 )
                 tokens_removed += block.total_tokens
-            # Else, remove one part at a time to ensure we do not over truncate.
+            # Else, remove only the leading parts needed to ensure we do not over truncate.
             else:
-                for i in range(block.left, block.right + 1):
-                    tokens_removed += len(self._parts[i].tokens)
-                    to_remove[i] = True
-                    if tokens_removed >= num_tokens_to_truncate:
-                        break
+                cumulative_tokens = list(
+                    accumulate(
+                        len(part.tokens)
+                        for part in self._parts[block.left : block.right + 1]
+                    )
+                )
+                # Index of the first part at which enough tokens have been removed.
+                cutoff = bisect_left(
+                    cumulative_tokens, num_tokens_to_truncate - tokens_removed
+                )
+                to_keep[block.left : block.left + cutoff + 1] = bytes(cutoff + 1)
+                tokens_removed += cumulative_tokens[cutoff]
 
             if tokens_removed >= num_tokens_to_truncate:
                 break
 
-        self._parts = [part for i, part in enumerate(self._parts) if not to_remove[i]]
+        self._parts = list(compress(self._parts, to_keep))
+        self._cached_tokens = None
 
     def _build_truncation_blocks(self) -> list[TruncationBlock]:
         """Builds a list of tuples representing the truncation steps."""
@@ -340,45 +473,30 @@ class Prompt:
 
         truncation_blocks: list[TruncationBlock] = []
         start = 0
-        first_part: PromptPart = self._parts[start]
-        current_truncation_priority = first_part.truncation_priority
-        total_block_tokens = len(first_part.tokens)
-        for idx in range(1, len(self._parts)):
-            current_part = self._parts[idx]
-            if current_part.tokens is None:
-                raise ValueError(f"Part has not been tokenized: {current_part=}")
-
-            # Accumulate tokens or mint a new truncation block.
-            if current_part.truncation_priority == current_truncation_priority:
+        # Group consecutive parts sharing a truncation priority into blocks.
+        for truncation_priority, block_parts in groupby(
+            self._parts, key=attrgetter("truncation_priority")
+        ):
+            num_block_parts = 0
+            total_block_tokens = 0
+            for current_part in block_parts:
+                if current_part.tokens is None:
+                    raise ValueError(f"Part has not been tokenized: {current_part=}")
+                num_block_parts += 1
                 total_block_tokens += len(current_part.tokens)
-            else:
-                truncation_block = TruncationBlock(
-                    left=start,
-                    right=idx - 1,
-                    truncation_priority=current_truncation_priority,
-                    total_tokens=total_block_tokens,
+
+            # Only truncate parts with non-zero and positive truncation priority.
+            if truncation_priority > 0:
+                truncation_blocks.append(
+                    TruncationBlock(
+                        left=start,
+                        right=start + num_block_parts - 1,
+                        truncation_priority=truncation_priority,
+                        total_tokens=total_block_tokens,
+                    )
                 )
-                truncation_blocks.append(truncation_block)
-
-                # Reset tracking parameters.
-                start = idx
-                current_truncation_priority = current_part.truncation_priority
-                total_block_tokens = len(current_part.tokens)
-
-        # Append the last block.
-        truncation_blocks.append(
-            TruncationBlock(
-                left=start,
-                right=len(self._parts) - 1,
-                truncation_priority=current_truncation_priority,
-                total_tokens=total_block_tokens,
-            )
-        )
+            start += num_block_parts
 
-        # Only truncate parts with non-zero and positive truncation priority.
-        truncation_blocks = [
-            block for block in truncation_blocks if block.truncation_priority > 0
-        ]
         truncation_blocks.sort(
             key=lambda marker: marker.truncation_priority, reverse=True
         )
@@ -395,15 +513,37 @@ class Prompt:
         num_surplus_tokens = max(0, self._total_tokens - token_limit)
         return math.ceil(num_surplus_tokens / truncation_step) * truncation_step
 
+    def _encode_batch(self, strings: list[str]) -> list[list[int]]:
+        """Encode a batch of strings into tokens."""
+        # Lazy load.
+        if self._encode_batch_func is None:
+            if self._encode_func is not None:
+                # A custom encode function was provided; apply it to each string.
+                encode_func = self._encode_func
+                self._encode_batch_func = lambda strings: [
+                    encode_func(string) for string in strings
+                ]
+            else:
+                self._encode_batch_func = get_encode_batch_func(
+                    encoding_name=self._tiktoken_encoding_name
+                )
+
+        return self._encode_batch_func(strings)
+
     def _tokenize_part(self, part: PromptPart, force_retokenize: bool = False):
         # Invalidate the cached tokens.
         self._cached_tokens = None
 
         # Lazy load.
         if self._encode_func is None:
-            self._encode_func = get_encode_func(
-                encoding_name=self._tiktoken_encoding_name
-            )
+            if self._encode_batch_func is not None:
+                # Only a custom batch encode function was provided; tokenize consistently.
+                encode_batch_func = self._encode_batch_func
+                self._encode_func = lambda string: encode_batch_func([string])[0]
+            else:
+                self._encode_func = get_encode_func(
+                    encoding_name=self._tiktoken_encoding_name
+                )
 
         # Avoid retokenizing the part if it has already been tokenized.
         if part.tokens and force_retokenize:
@@ -412,6 +552,8 @@ class Prompt:
             self.logger.warning("Part already tokenized... skipping tokenization.")
             return
 
+        if part.tokens is None:
+            self._untokenized_parts -= 1
         part.tokens = self._encode_func(part.content)
         self._total_tokens += len(part.tokens)
 
@@ -428,22 +570,21 @@ class Prompt:
         self._template_data["token_limit"] = self._token_limit
         self._template_data[
             "escape_special_characters"
-        ] = self._escape_special_characters
+        ] = self._cached_escape_special_characters
 
         if self._from_examples:
-            cai_functions = {}
-            for name, obj in inspect.getmembers(cai_helpers):
-                if inspect.isfunction(obj):
-                    cai_functions[name] = obj
-            self._template_data.update(cai_functions)
+            self._template_data.update(cai_helpers._JINJA_EXPORTS)
 
     def _render_parts(self):
         self._rendered_template = self._template.render_template(self._template_data)
-        loaded_yaml = yaml.load(self._rendered_template, Loader=yaml.CSafeLoader)
+        if self._template_format == "json":
+            loaded_parts = json.loads(self._rendered_template)
+        else:
+            loaded_parts = self._iter_yaml_parts()
 
         # TODO: Process parts in parallel for speedup.
-        self._parts = [None] * len(loaded_yaml)
-        for idx, yaml_part in enumerate(loaded_yaml):
+        self._parts = []
+        for yaml_part in loaded_parts:
             part = PromptPart(**yaml_part)
             if not self._allow_token_overrides and part.tokens is not None:
                 raise ValueError(
@@ -451,15 +592,33 @@ class Prompt:
                 )
             self._validate_template_replacements(part)
             self._cleanup_content(part)
-            self._parts[idx] = part
+            self._parts.append(part)
 
+            if part.tokens is None:
+                self._untokenized_parts += 1
             # Tokens were passed in the yaml; ensure we track them.
-            if part.tokens is not None:
+            else:
                 self.logger.warning(
                     "Tokens were provided in template. Regular tokenization will be skipped."
                 )
                 self._total_tokens += len(part.tokens)
-    
+
+    def _iter_yaml_parts(self) -> Iterator[dict]:
+        """Construct the yaml parts one at a time from the rendered template.
+
+        Avoids materializing the full list of parts before building `PromptPart`s.
+        """
+        loader = yaml.CSafeLoader(self._rendered_template)
+        try:
+            node = loader.get_single_node()
+            if isinstance(node, yaml.SequenceNode):
+                for item_node in node.value:
+                    yield loader.construct_document(item_node)
+            else:
+                yield from loader.construct_document(node) if node else []
+        finally:
+            loader.dispose()
+
     def _validate_template_replacements(self, part: PromptPart):
         """Validate that all required keys in the expected_template_data_keys are present in template_data."""
         if part.expected_template_data_keys:
@@ -469,11 +628,26 @@ class Prompt:
 
     def _cleanup_content(self, part: PromptPart):
         """Remove whitespace and unescape special characters, if present."""
-        content = part.content.strip().replace(self._space_marker, " ")
-        part.content = self._unescape_special_characters(content)
+        content = part.content.strip()
+        # Skip the replacements entirely for content without special sequences.
+        if self._space_marker in content:
+            content = content.replace(self._space_marker, " ")
+        # JSON content is loaded verbatim, so escape sequences in it are literal text.
+        needs_unescape = self._template_format != "json" and (
+            self._escaped_newline in content
+            or self._escaped_carriage_return in content
+            or self._escaped_single_quote in content
+        )
+        if needs_unescape:
+            content = self._unescape_special_characters(content)
+        part.content = content
 
     def _escape_special_characters(self, string: str) -> str:
         """Escape sequences that will break yaml parsing."""
+        # Fast path: a single pass over the string.
+        if self._escape_table is not None:
+            return string.translate(self._escape_table)
+
         return (
             string.replace(self._newline, self._escaped_newline)
             .replace(self._carriage_return, self._escaped_carriage_return)
@@ -496,10 +670,12 @@ class Prompt:
         # Reset the parts to the pretruncation state, if necessary. Ensures idempotency.
         self._cached_tokens = None
         if self._parts_bak:
-            self._parts = copy.deepcopy(self._parts_bak)
+            self._parts = _clone_parts(self._parts_bak)
         else:
             self.logger.warning(
-                f"No parts backup. Skipping reset: {self._parts_bak=} {self._parts=}"
+                "No parts backup. Skipping reset: self._parts_bak=%r self._parts=%r",
+                self._parts_bak,
+                self._parts,
             )
             return
 
@@ -2,10 +2,19 @@
 
 import logging
 import os
+from functools import lru_cache
 
 import jinja2 as j2
 from template_registry import TemplateRegistry
 
+RAW_TEMPLATE_CACHE_MAX_SIZE = 1024
+_DEFAULT_LOGGER = logging.getLogger(__name__)
+
+# Shared environment used to compile raw templates; raw templates have no loader.
+_RAW_TEMPLATE_ENV = j2.Environment(
+    auto_reload=False, optimized=True, cache_size=RAW_TEMPLATE_CACHE_MAX_SIZE
+)
+
 
 class Template:
     """A Prompt Poet (PP) template orignally represented as a valid *.yaml.j2 file.
@@ -80,7 +89,7 @@ class Template:
         if self._provided_logger:
             return self._provided_logger
 
-        return logging.getLogger(__name__)
+        return _DEFAULT_LOGGER
 
     @property
     def template_name(self) -> str:
@@ -100,7 +109,7 @@ class Template:
     def _load_template(self):
         """Load a jinja2 template."""
         if self._raw_template:
-            self._template = j2.Template(self._raw_template)
+            self._template = _compile_raw_template(self._raw_template)
         else:
             registry = TemplateRegistry(logger=self._provided_logger)
             self._template = registry.get_template(
@@ -127,3 +136,9 @@ class Template:
         if not template_dir:
             template_dir = "."
         return template_dir, template_name
+
+
+@lru_cache(maxsize=RAW_TEMPLATE_CACHE_MAX_SIZE)
+def _compile_raw_template(raw_template: str) -> j2.Template:
+    """Compile a raw template string once and reuse it across prompts."""
+    return _RAW_TEMPLATE_ENV.from_string(raw_template)
@@ -2,12 +2,24 @@
 
 import logging
 import os
+from collections import OrderedDict
+from importlib import resources
+from threading import Lock
 
 import jinja2 as j2
-from cachetools import TTLCache
 
 CACHE_MAX_SIZE = 100
+# Deprecated: cached templates are now invalidated when their file is modified.
 CACHE_TTL_SECS = 30
+ENV_CACHE_SIZE = 1024
+# Directory for compiled template bytecode; the bytecode cache is disabled if unset.
+BYTECODE_CACHE_DIR_ENV_VAR = "PP_BCC_DIR"
+
+_DEFAULT_LOGGER = logging.getLogger(__name__)
+_registry_lock = Lock()
+_env_lock = Lock()
+_ENV_CACHE: dict[tuple[str | None, str], j2.Environment] = {}
+_BYTECODE_CACHE = None
 
 
 class TemplateRegistry:
@@ -18,9 +30,12 @@ class TemplateRegistry:
     def __new__(cls, *args, **kwargs):
         """Singleton pattern that allows arbitrary arguments."""
         if cls._instance is None:
-            cls._instance = super(TemplateRegistry, cls).__new__(cls)
-            # Initialize _instance's attributes
-            cls._instance._initialized = False
+            with _registry_lock:
+                if cls._instance is None:
+                    instance = super(TemplateRegistry, cls).__new__(cls)
+                    # Initialize _instance's attributes
+                    instance._initialized = False
+                    cls._instance = instance
 
         return cls._instance
 
@@ -28,17 +43,55 @@ class TemplateRegistry:
         self,
         logger: logging.LoggerAdapter = None,
         reset: bool = False,
-        cache_max_size: int = CACHE_MAX_SIZE,
+        cache_max_size: int = None,
         cache_ttl_secs: int = CACHE_TTL_SECS,
     ):
-        """Initialize template engine."""
-        self._provided_logger = logger
+        """Initialize template engine.
 
-        if not self._initialized or reset:
-            self._cache = TTLCache(maxsize=cache_max_size, ttl=cache_ttl_secs)
+        Only the first construction (or one with `reset`) creates the cache; later
+        constructions only set the logger.
+        """
+        del cache_ttl_secs  # Deprecated; kept for backwards compatibility.
+
+        # Fast path: already initialized.
+        if self._initialized and not reset:
+            self._update_initialized(logger=logger, cache_max_size=cache_max_size)
+            return
+
+        with _registry_lock:
+            if self._initialized and not reset:
+                self._update_initialized(logger=logger, cache_max_size=cache_max_size)
+                return
+
+            self._provided_logger = logger
+            # An LRU cache mapping keys to (template file (mtime, size), template).
+            self._cache: OrderedDict[
+                tuple[str | None, str, str],
+                tuple[tuple[int, int] | None, j2.Template],
+            ] = OrderedDict()
+            self._cache_max_size = (
+                cache_max_size if cache_max_size is not None else CACHE_MAX_SIZE
+            )
             self._default_template = None
             self._initialized = True
 
+    def set_logger(self, logger: logging.LoggerAdapter | None):
+        """Set the logger to be used by this module."""
+        self._provided_logger = logger
+
+    def _update_initialized(
+        self, logger: logging.LoggerAdapter | None, cache_max_size: int | None
+    ):
+        """Apply constructor arguments to the already initialized singleton."""
+        self.set_logger(logger)
+        if cache_max_size is not None and cache_max_size != self._cache_max_size:
+            self.logger.warning(
+                "Ignoring cache_max_size=%r; the registry is already initialized with "
+                "cache_max_size=%r. Pass reset=True to recreate its cache.",
+                cache_max_size,
+                self._cache_max_size,
+            )
+
     def get_template(
         self,
         template_name: str,
@@ -56,8 +109,11 @@ class TemplateRegistry:
             `package_name`.
         :param use_examples: An optional parameter indicating to use the
             examples packaged into the the Prompt Poet package.
-        :param use_cache: An optional parameter indicating to use the
-            examples packaged into the the Prompt Poet package.
+        :param use_cache: An optional parameter indicating to use a previously
+            loaded template, as long as its file's modification time and size are
+            unchanged. A same-size rewrite within the filesystem's timestamp
+            granularity, or modifications to included templates alone, are not
+            detected.
         """
         if template_dir.endswith("/"):
             raise ValueError(
@@ -70,14 +126,32 @@ class TemplateRegistry:
             package_name=package_name,
         )
 
-        load_from_disk = not use_cache or cache_key not in self._cache
+        file_signature = self._get_file_signature(
+            template_name=template_name,
+            template_dir=template_dir,
+            package_name=package_name,
+        )
 
-        if load_from_disk:
-            self._cache[cache_key] = self._load_template(
-                template_name, template_dir=template_dir, package_name=package_name
-            )
+        with _registry_lock:
+            cached = self._cache.get(cache_key)
+            if use_cache and cached is not None and file_signature is not None:
+                cached_file_signature, template = cached
+                if file_signature == cached_file_signature:
+                    self._cache.move_to_end(cache_key)
+                    return template
 
-        return self._cache[cache_key]
+        template = self._load_template(
+            template_name,
+            template_dir=template_dir,
+            package_name=package_name,
+            reload=cached is not None and cached[0] != file_signature,
+        )
+        with _registry_lock:
+            self._cache[cache_key] = (file_signature, template)
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > self._cache_max_size:
+                self._cache.popitem(last=False)
+        return template
 
     @property
     def logger(self) -> str:
@@ -85,41 +159,90 @@ class TemplateRegistry:
         if self._provided_logger:
             return self._provided_logger
 
-        return logging.getLogger(__name__)
+        return _DEFAULT_LOGGER
 
     def _build_cache_key(
         self, template_name: str, template_dir: str, package_name: str
-    ) -> str:
-        key = f"{template_dir}/{template_name}"
-        if package_name:
-            key = f"{package_name}:{key}"
-        return key
+    ) -> tuple[str | None, str, str]:
+        return (package_name, template_dir, template_name)
+
+    def _get_file_signature(
+        self, template_name: str, template_dir: str, package_name: str
+    ) -> tuple[int, int] | None:
+        """The modification time and size of the template file, if determinable.
+
+        The size catches most rewrites within the filesystem's timestamp granularity,
+        though not those keeping the same size.
+        """
+        try:
+            if package_name is not None:
+                path = resources.files(package_name) / template_dir / template_name
+            else:
+                path = os.path.join(template_dir, template_name)
+            stat = os.stat(path)
+            return stat.st_mtime_ns, stat.st_size
+        except (OSError, TypeError, ModuleNotFoundError):
+            return None
 
     def _load_template(
         self,
         template_name: str,
         template_dir: str = None,
         package_name: str = None,
+        reload: bool = False,
     ) -> j2.Template:
-        """Load template from disk."""
-        loader = None
+        """Load template from disk.
+
+        Unchanged templates are served from the environment's compiled templates;
+        `reload` forces the sources to be re-read.
+        """
         if template_dir is None and package_name is None:
             raise ValueError(
                 "Either `template_dir` or `package_name` must be provided."
             )
 
-        try:
+        env = _get_environment(template_dir=template_dir, package_name=package_name)
+        if reload:
+            # Jinja only compares mtimes; a rewrite within their granularity would be
+            # missed, so drop the compiled templates (and any changed includes).
+            env.cache.clear()
+        return env.get_template(template_name)
+
+
+def _get_environment(template_dir: str, package_name: str = None) -> j2.Environment:
+    """Get the shared jinja2 environment for a template directory, creating it once."""
+    key = (package_name, template_dir)
+    env = _ENV_CACHE.get(key)
+    if env is not None:
+        return env
+
+    with _env_lock:
+        env = _ENV_CACHE.get(key)
+        if env is None:
             if package_name is not None:
                 loader = j2.PackageLoader(
                     package_name=package_name, package_path=template_dir
                 )
             else:
                 loader = j2.FileSystemLoader(searchpath=template_dir)
-        except j2.TemplateNotFound as ex:
-            raise j2.TemplateNotFound(
-                f"Template not found: {ex} {template_name=} {template_dir=} {package_name=}"
-            )
 
-        env = j2.Environment(loader=loader)
-        template = env.get_template(template_name)
-        return template
+            env = j2.Environment(
+                loader=loader,
+                # Recompile templates, including includes, whose sources changed.
+                auto_reload=True,
+                optimized=True,
+                cache_size=ENV_CACHE_SIZE,
+                bytecode_cache=_get_bytecode_cache(),
+            )
+            _ENV_CACHE[key] = env
+    return env
+
+
+def _get_bytecode_cache() -> j2.FileSystemBytecodeCache | None:
+    """Lazily create the bytecode cache shared by all environments, if enabled."""
+    global _BYTECODE_CACHE
+    directory = os.environ.get(BYTECODE_CACHE_DIR_ENV_VAR)
+    if _BYTECODE_CACHE is None and directory:
+        os.makedirs(directory, exist_ok=True)
+        _BYTECODE_CACHE = j2.FileSystemBytecodeCache(directory=directory)
+    return _BYTECODE_CACHE
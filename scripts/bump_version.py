@@ -14,12 +14,11 @@ def bump_version(version: str) -> str:
     return f"{major}.{minor}.{patch}"
 
 
-with open(os.path.join(root, "VERSION")) as version_file:
+with open(os.path.join(root, "VERSION"), "r+") as version_file:
     current_version = version_file.read().strip()
-
-new_version = bump_version(current_version)
-
-with open(os.path.join(root, "VERSION"), "w") as version_file:
+    new_version = bump_version(current_version)
+    version_file.seek(0)
+    version_file.truncate()
     version_file.write(new_version + "\n")
 
 print(f"Bumped version from {current_version} to {new_version}")
@@ -2,7 +2,7 @@
 
 import os
 
-from setuptools import find_packages, setup
+from setuptools import setup
 
 # Get the current directory of the setup.py script
 here = os.path.abspath(os.path.dirname(__file__))
@@ -14,13 +14,12 @@ with open(os.path.join(here, "VERSION")) as version_file:
 setup(
     name="prompt_poet",
     version=version,
-    packages=find_packages(include=["prompt_poet", "prompt_poet.*"]),
+    packages=["prompt_poet"],
     include_package_data=True,
     package_data={"prompt_poet": ["examples/*.yml.j2"]},
     install_requires=[
         "jinja2>=3.0.0",
         "PyYaml>=6.0.0",
-        "cachetools==5.3.3",
         "tiktoken==0.7.0",
     ],
     author="James Groeneveld",
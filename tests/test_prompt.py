@@ -1,26 +1,34 @@
+import logging
 import os
 import pytest
 
-from examples.cai_helpers import CAIMessage
+from examples.cai_helpers import CAIMessage, pretruncate_messages
 import jinja2 as j2
 from pp_exceptions import TruncationError
 from prompt import Prompt
+from template import Template
+import template_registry
+from template_registry import TemplateRegistry
 from tiktoken import get_encoding
+from tokenizer import PARALLEL_ENCODE_MIN_TOTAL_CHARS, get_encode_batch_func
 
 CWD = os.path.dirname(__file__)
+TEMPLATES_DIR = os.path.abspath(os.path.join(CWD, "templates"))
 TIKTOKEN_ENCODING_NAME = "o200k_base"
 ENCODE_FUNC = get_encoding(TIKTOKEN_ENCODING_NAME).encode
 
 
+def _t(name: str) -> str:
+    return os.path.join(TEMPLATES_DIR, name)
+
+
 def test_simple_prompt_sad():
     with pytest.raises(
         ValueError, match="`token_limit` is a reserved key in the template data."
     ):
         _ = Prompt(
             template_data={"var1": "foobar", "token_limit": 10},
-            template_path=os.path.abspath(
-                os.path.join(CWD, "templates", "simple_prompt.yml.j2")
-            ),
+            template_path=_t("simple_prompt.yml.j2"),
         )
 
     with pytest.raises(
@@ -29,26 +37,20 @@ def test_simple_prompt_sad():
     ):
         _ = Prompt(
             template_data={"var1": "foobar", "escape_special_characters": lambda x: x},
-            template_path=os.path.abspath(
-                os.path.join(CWD, "templates", "simple_prompt.yml.j2")
-            ),
+            template_path=_t("simple_prompt.yml.j2"),
         )
 
 
 def test_simple_prompt_happy():
     prompt = Prompt(
         template_data={"var1": "foobar"},
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "simple_prompt.yml.j2")
-        ),
+        template_path=_t("simple_prompt.yml.j2"),
     )
     assert prompt.string == "Raw string of the first part foobar"
 
     prompt = Prompt(
         template_data={"var1": "foobar"},
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "simple_prompt.yml.j2"),
-        ),
+        template_path=_t("simple_prompt.yml.j2"),
     )
     assert prompt.string == "Raw string of the first part foobar"
 
@@ -56,9 +58,7 @@ def test_simple_prompt_happy():
 def test_section_prompt_happy():
     prompt = Prompt(
         template_data={"var1": "foobar"},
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "section_prompt.yml.j2"),
-        ),
+        template_path=_t("section_prompt.yml.j2"),
     )
     assert prompt.string == "Raw string of section_aRaw string of section_b"
 
@@ -66,9 +66,7 @@ def test_section_prompt_happy():
 def test_macros_prompt_happy():
     prompt = Prompt(
         template_data={"var1": "foobar"},
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "macros_prompt.yml.j2"),
-        ),
+        template_path=_t("macros_prompt.yml.j2"),
     )
     assert (
         prompt.string
@@ -83,9 +81,7 @@ def test_function_prompt_happy():
             "var2": "bar",
             "concat_strings": lambda x, y: x + y,
         },
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "function_prompt.yml.j2"),
-        ),
+        template_path=_t("function_prompt.yml.j2"),
     )
     assert prompt.string == "foobar"
 
@@ -94,27 +90,21 @@ def test_template_not_found():
     with pytest.raises(j2.TemplateNotFound):
         _ = Prompt(
             template_data={"var1": "foobar"},
-            template_path=os.path.abspath(
-                os.path.join(CWD, "templates", "non_existent_template.yml.j2")
-            ),
+            template_path=_t("non_existent_template.yml.j2"),
         )
 
 
 def test_control_flow_happy():
     prompt = Prompt(
         template_data={"conditional": True},
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "control_flow_prompt.yml.j2"),
-        ),
+        template_path=_t("control_flow_prompt.yml.j2"),
     )
     assert "Raw string of conditional" in prompt.string
     assert "Raw string of item" not in prompt.string
 
     prompt = Prompt(
         template_data={"conditional": False, "items": ["item1", "item2", "item3"]},
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "control_flow_prompt.yml.j2"),
-        ),
+        template_path=_t("control_flow_prompt.yml.j2"),
     )
     assert "Raw string of conditional" not in prompt.string
     assert "Raw string of item item1" in prompt.string
@@ -123,9 +113,7 @@ def test_control_flow_happy():
 
     prompt = Prompt(
         template_data={"conditional": True, "items": ["item1", "item2", "item3"]},
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "control_flow_prompt.yml.j2"),
-        ),
+        template_path=_t("control_flow_prompt.yml.j2"),
     )
     assert "Raw string of conditional" in prompt.string
     assert "Raw string of item item1" in prompt.string
@@ -136,25 +124,19 @@ def test_control_flow_happy():
 def test_scanner_error():
     prompt = Prompt(
         template_data={"var1": "foo\u2028bar"},
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "simple_prompt.yml.j2")
-        ),
+        template_path=_t("simple_prompt.yml.j2"),
     )
     assert prompt.string == "Raw string of the first part foo\\u2028bar"
 
     prompt = Prompt(
         template_data={"var1": "foo\u2029bar"},
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "simple_prompt.yml.j2")
-        ),
+        template_path=_t("simple_prompt.yml.j2"),
     )
     assert prompt.string == "Raw string of the first part foo\\u2029bar"
 
     prompt = Prompt(
         template_data={"var1": "foo\u0085bar"},
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "simple_prompt.yml.j2")
-        ),
+        template_path=_t("simple_prompt.yml.j2"),
     )
     assert prompt.string == "Raw string of the first part foo\\u0085bar"
 
@@ -255,6 +237,9 @@ def test_example_cai_template_happy():
         prompt.string
         == "<|beginningofdialog|>2024 06 24 Bob: The \r title - The description<|endofmessage|><|beginningofmessage|>narrator: The definition<|endofmessage|><|beginningofmessage|>narrator: With multiple lines<|endofmessage|><|beginningofmessage|>narrator: In the definition<|endofmessage|><|beginningofmessage|>Jeff: The persona \r definition<|endofmessage|><|beginningofmessage|>Alice: The third message<|endofmessage|><|beginningofmessage|>Alice: The first \n \n message<|endofmessage|><|beginningofmessage|>Jeff: The second \r message<|endofmessage|><|beginningofmessage|>Alice: The third message<|endofmessage|><|beginningofmessage|>Jeff: The fourth ' message<|endofmessage|><|beginningofmessage|>Alice:"
     )
+    # Only the exact prefix is replaced, not any leading characters found in it.
+    prompt.lreplace_at(old="<|beginningofmessage|>", new="", index=2)
+    assert prompt.parts[2].content == "narrator: The definition<|endofmessage|>"
     with pytest.raises(IndexError, match="Index out of bounds:"):
         prompt.lreplace_at(old="<|beginningofmessage|>", new=" ", index=999)
 
@@ -278,9 +263,7 @@ def test_truncation_template_happy():
             ],
         },
         encode_func=ENCODE_FUNC,
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "truncation_prompt.yml.j2"),
-        ),
+        template_path=_t("truncation_prompt.yml.j2"),
         allow_token_overrides=True,
     )
     prompt.tokenize()
@@ -318,9 +301,7 @@ def test_truncation_template_happy():
             ],
         },
         encode_func=ENCODE_FUNC,
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "truncation_prompt.yml.j2"),
-        ),
+        template_path=_t("truncation_prompt.yml.j2"),
         allow_token_overrides=True,
     )
     prompt.tokenize()
@@ -339,9 +320,7 @@ def test_escape_characters():
     # Implicitly assert that no YAML parsing exception is raised.
     _ = Prompt(
         template_data={"var1": "foobar\nkey:value"},
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "simple_prompt.yml.j2")
-        ),
+        template_path=_t("simple_prompt.yml.j2"),
     )
 
 
@@ -355,9 +334,7 @@ def test_truncation_failure():
             ],
         },
         encode_func=ENCODE_FUNC,
-        template_path=os.path.abspath(
-            os.path.join(CWD, "templates", "truncation_prompt.yml.j2"),
-        ),
+        template_path=_t("truncation_prompt.yml.j2"),
         allow_token_overrides=True,
     )
     prompt.tokenize()
@@ -483,4 +460,202 @@ def test_tiktoken_encoding_name():
         tiktoken_encoding_name="r50k_base",
     )
     prompt.tokenize()
-    assert prompt.tokens
\ No newline at end of file
+    assert prompt.tokens
+
+def test_tokenize_batch():
+    prompt = Prompt(
+        template_data={
+            "timestamp": "2024 06 24",
+            "username": "Jeff",
+            "character": {
+                "title": "The title",
+                "description": "The description",
+                "definition": "The definition\nWith multiple lines\nIn the definition",
+                "participant__name": "Alice",
+            },
+            "persona_definition": "The persona definition",
+            "cai_messages": [
+                CAIMessage(author="Alice", text="The first message"),
+                CAIMessage(author="Jeff", text="The second message"),
+            ],
+            "reply_prompt": "Alice:",
+        },
+        template_path="cai.yml.j2",
+        from_examples=True,
+    )
+    prompt.tokenize()
+    for part in prompt.parts:
+        assert part.tokens == ENCODE_FUNC(part.content)
+    assert len(prompt.tokens) == sum(len(part.tokens) for part in prompt.parts)
+
+    # A custom batch encode function is called once for all parts.
+    batches = []
+
+    def encode_batch_func(strings):
+        batches.append(strings)
+        return [[len(string)] for string in strings]
+
+    prompt = Prompt(
+        template_data={"var1": "foobar"},
+        template_path=_t("section_prompt.yml.j2"),
+        encode_batch_func=encode_batch_func,
+    )
+    prompt.tokenize()
+    assert batches == [["Raw string of section_a", "Raw string of section_b"]]
+    assert prompt.tokens == [23, 23]
+
+    # Duplicate part contents are only encoded once.
+    batches.clear()
+    prompt = Prompt(
+        template_data={"conditional": False, "items": ["item1", "item1", "item2"]},
+        template_path=_t("control_flow_prompt.yml.j2"),
+        encode_batch_func=encode_batch_func,
+    )
+    prompt.tokenize()
+    assert len(batches) == 1
+    assert len(batches[0]) == len(set(batches[0])) == len(prompt.parts) - 1
+    assert len(prompt.tokens) == len(prompt.parts)
+
+    # Parts never share token lists, with each other or with the pretruncation parts.
+    prompt.truncate(token_limit=len(prompt.parts), truncation_step=1)
+    prompt.parts[0].tokens.append(-1)
+    assert prompt.parts[1].tokens == [len(prompt.parts[1].content)]
+    assert prompt.pretruncation_parts[0].tokens == [len(prompt.parts[0].content)]
+
+
+def test_raw_template_happy():
+    raw_template = """
+- name: first part
+  content: Raw string of the first part {{ var1 }}
+"""
+    prompt = Prompt(template_data={"var1": "foo"}, raw_template=raw_template)
+    assert prompt.string == "Raw string of the first part foo"
+
+    # The compiled template is reused for identical raw templates.
+    other_prompt = Prompt(template_data={"var1": "bar"}, raw_template=raw_template)
+    assert other_prompt.string == "Raw string of the first part bar"
+    assert other_prompt._template.template is prompt._template.template
+
+
+def test_json_template_format():
+    prompt = Prompt(
+        template_data={"var1": "foo\nbar: 'baz'", "var2": "<|endofmessage|>"},
+        template_path=_t("simple_prompt.json.j2"),
+        template_format="json",
+    )
+    assert prompt.string == "Raw string of the first part foo\nbar: 'baz'<|endofmessage|>"
+    assert prompt.messages[1] == {"role": "system", "content": "<|endofmessage|>"}
+
+    # Literal backslash sequences are kept rather than unescaped as in yaml templates.
+    prompt = Prompt(
+        template_data={"var1": "C:\\new\\r \\'", "var2": "\\n"},
+        template_path=_t("simple_prompt.json.j2"),
+        template_format="json",
+    )
+    assert prompt.string == "Raw string of the first part C:\\new\\r \\'\\n"
+
+    with pytest.raises(ValueError, match="template_format must be one of"):
+        _ = Prompt(
+            template_data={"var1": "foobar"},
+            template_path=_t("simple_prompt.yml.j2"),
+            template_format="toml",
+        )
+
+
+def test_pretruncate_messages():
+    messages = [CAIMessage(author="Alice", text=str(i)) for i in range(25)]
+    assert pretruncate_messages(messages, token_limit=-1) == messages
+    assert pretruncate_messages(messages, token_limit=100) == messages[10:]
+    assert pretruncate_messages(messages, token_limit=50) == messages[15:]
+    assert pretruncate_messages(messages, token_limit=200) == messages
+    # A truncation step of zero leaves the messages untouched.
+    assert pretruncate_messages(messages, token_limit=5) == messages
+
+
+def test_template_reloaded_from_disk(tmp_path):
+    template_path = tmp_path / "reload_prompt.yml.j2"
+    template_path.write_text("- name: part\n  content: first version\n")
+    prompt = Prompt(template_data={}, template_path=str(template_path))
+    assert prompt.string == "first version"
+
+    # Without `from_cache`, changes to the template on disk are picked up.
+    template_path.write_text("- name: part\n  content: second version\n")
+    prompt = Prompt(template_data={}, template_path=str(template_path))
+    assert prompt.string == "second version"
+
+    # Unchanged templates are not recompiled.
+    template = Template(template_path=str(template_path)).template
+    assert Template(template_path=str(template_path)).template is template
+
+    # Changes to included templates are picked up as well.
+    include_path = tmp_path / "included_part.yml.j2"
+    include_path.write_text("- name: included\n  content: first include\n")
+    template_path.write_text('{% include "included_part.yml.j2" %}\n')
+    prompt = Prompt(template_data={}, template_path=str(template_path))
+    assert prompt.string == "first include"
+
+    include_path.write_text("- name: included\n  content: second include\n")
+    # Jinja checks included templates by mtime; make sure it has moved on.
+    stat = os.stat(include_path)
+    os.utime(include_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    prompt = Prompt(template_data={}, template_path=str(template_path))
+    assert prompt.string == "second include"
+
+
+def test_cached_template_invalidated_on_modification(tmp_path):
+    template_path = tmp_path / "cached_prompt.yml.j2"
+    template_path.write_text("- name: part\n  content: first version\n")
+    prompt = Prompt(template_data={}, template_path=str(template_path), from_cache=True)
+    cached_template = prompt._template.template
+    prompt = Prompt(template_data={}, template_path=str(template_path), from_cache=True)
+    assert prompt._template.template is cached_template
+
+    # A rewrite changing the file's size is detected even within the timestamp
+    # granularity of the filesystem.
+    template_path.write_text("- name: part\n  content: second version\n")
+    prompt = Prompt(template_data={}, template_path=str(template_path), from_cache=True)
+    assert prompt.string == "second version"
+
+
+def test_bytecode_cache_opt_in(tmp_path, monkeypatch):
+    monkeypatch.setattr(template_registry, "_BYTECODE_CACHE", None)
+    monkeypatch.delenv(template_registry.BYTECODE_CACHE_DIR_ENV_VAR, raising=False)
+    assert template_registry._get_bytecode_cache() is None
+
+    bytecode_dir = tmp_path / "bcc"
+    monkeypatch.setenv(template_registry.BYTECODE_CACHE_DIR_ENV_VAR, str(bytecode_dir))
+    template_path = tmp_path / "bytecode_prompt.yml.j2"
+    template_path.write_text("- name: part\n  content: compiled\n")
+    prompt = Prompt(template_data={}, template_path=str(template_path))
+    assert prompt.string == "compiled"
+    assert list(bytecode_dir.iterdir())
+
+
+def test_template_registry_logger(caplog):
+    for request_id in ("request-41", "request-42"):
+        logger = logging.LoggerAdapter(logging.getLogger(request_id), {})
+        Template(template_path=_t("simple_prompt.yml.j2"), logger=logger)
+        assert TemplateRegistry._instance.logger is logger
+
+    # Arguments that only apply on initialization are ignored with a warning.
+    registry = TemplateRegistry(cache_max_size=template_registry.CACHE_MAX_SIZE + 1)
+    assert registry._cache_max_size == template_registry.CACHE_MAX_SIZE
+    assert "Ignoring cache_max_size" in caplog.text
+
+
+def test_encode_batch_func():
+    encode_batch = get_encode_batch_func()
+    assert encode_batch(["<|beginningofmessage|>", "narrator: foo"]) == [
+        ENCODE_FUNC("<|beginningofmessage|>"),
+        ENCODE_FUNC("narrator: foo"),
+    ]
+
+    # Special tokens in the text are encoded as ordinary text rather than raising.
+    assert encode_batch(["<|endoftext|>"]) == [
+        ENCODE_FUNC("<|endoftext|>", disallowed_special=())
+    ]
+
+    # Large batches are encoded in parallel with the same result.
+    strings = [f"message {i} " * 1000 for i in range(4)]
+    assert sum(map(len, strings)) >= PARALLEL_ENCODE_MIN_TOTAL_CHARS
+    assert encode_batch(strings) == [ENCODE_FUNC(string) for string in strings]